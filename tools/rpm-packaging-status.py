@@ -16,25 +16,119 @@
 
 import argparse
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import html
+from lxml import etree
 import os
 from packaging import version
 from packaging.requirements import Requirement
+import pymod2pkg
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import sys
 import yaml
 import json
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 # the current 'in development' release
 CURRENT_MASTER = 'xena'
 
 # the host where to query for open reviews
 GERRIT_HOST = 'https://review.opendev.org'
 
+# max number of threads used to process the projects
+MAX_WORKERS = 16
+
+# session used for all http requests so connections get reused
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20))
+
+# parsing versions is expensive and the same strings get parsed many times
+_parse = functools.lru_cache(maxsize=4096)(version.parse)
+
+ZERO_VERSION = _parse('0')
+
+# the mapping from a python module to a distro package name is fixed
+_module2package = functools.lru_cache(maxsize=None)(pymod2pkg.module2package)
+
+_UPSTREAM_RE = re.compile(
+    r"{%\s*set upstream_version\s*=\s*(?:upstream_version\()?"
+    r"'(?P<version>.*)'(?:\))?\s*%}$")
+_VERSION_RE = re.compile(r'^Version:\s*(?P<version>.*)\s*$')
+# [epoch:]name-version-release.arch.rpm
+_RPM_RE = re.compile(r'^(?:(?P<epoch>\d+):)?(?P<name>.+)-(?P<ver>[^-]+)-'
+                     r'(?P<rel>[^-]+)\.(?P<arch>[^.]+)\.rpm$')
+
+# background color of the comment column in the html output
+COMMENT_COLORS = {
+    'unpackaged': 'yellow',
+    'needs upgrade': 'LightYellow',
+    'needs downgrade': 'red',
+    'needs downgrade (u-c)': 'red',
+    'ok': 'green',
+}
+
 V = namedtuple('V', ['release', 'upper_constraints', 'rpm_packaging_pkg',
                      'reviews', 'obs_published'])
 
 
+def _process_project(yaml_file, args, upper_constraints, open_reviews,
+                     obs_index):
+    """get the different versions for the project described by the given
+    openstack/releases yaml file. Returns a (project_name, V) tuple or None
+    if the project should be skipped"""
+    project_name = re.sub(r'\.ya?ml$', '', os.path.basename(yaml_file))
+    # skip projects if include list is given
+    if len(args['include_projects']) and \
+       project_name not in args['include_projects']:
+        return None
+    with open(yaml_file) as f:
+        data = yaml.load(f, Loader=_Loader)
+        if 'releases' not in data or not data['releases']:
+            # there might be yaml files without any releases
+            return None
+        v_release = find_highest_release_version(data['releases'])
+    # use tarball-base name if available
+    project_name_pkg = v_release['projects'][0].get('tarball-base',
+                                                    project_name)
+
+    # get version from upper-constraints.txt
+    if project_name in upper_constraints:
+        v_upper_constraints = upper_constraints[project_name]
+    else:
+        v_upper_constraints = '-'
+
+    # path to the corresponding .spec.j2 file
+    rpm_packaging_pkg_project_spec = os.path.join(
+        args['rpm-packaging-git-dir'],
+        'openstack', project_name_pkg,
+        '%s.spec.j2' % project_name_pkg)
+    v_rpm_packaging_pkg = find_rpm_packaging_pkg_version(
+        rpm_packaging_pkg_project_spec)
+
+    # version from build service published file
+    v_obs_published = find_openbuildservice_pkg_version(
+        obs_index, project_name)
+
+    # reviews for the given project
+    if project_name in open_reviews:
+        project_reviews = open_reviews[project_name]
+    else:
+        project_reviews = []
+
+    return project_name, V(_parse(v_release['version']),
+                           v_upper_constraints,
+                           v_rpm_packaging_pkg,
+                           project_reviews,
+                           v_obs_published)
+
+
 def _process_status(args=None):
     projects = {}
 
@@ -44,62 +138,35 @@ def _process_status(args=None):
     # open reviews for the given release
     open_reviews = _gerrit_open_reviews_per_file(args['release'])
 
+    # versions from the build service published file
+    obs_index = _load_obs_index(args['obs_published_xml'])
+
     # directory which contains all yaml files from the openstack/release
     # git dir
     releases_yaml_dir = os.path.join(args['releases-git-dir'], 'deliverables',
                                      args['release'])
     releases_indep_yaml_dir = os.path.join(args['releases-git-dir'],
                                            'deliverables', '_independent')
-    yaml_files = [os.path.join(releases_indep_yaml_dir, f)
-                  for f in os.listdir(releases_indep_yaml_dir)]
-    yaml_files += [os.path.join(releases_yaml_dir, f)
-                   for f in os.listdir(releases_yaml_dir)]
-    for yaml_file in yaml_files:
-        project_name = re.sub(r'\.ya?ml$', '', os.path.basename(yaml_file))
-        # skip projects if include list is given
-        if len(args['include_projects']) and \
-           project_name not in args['include_projects']:
-            continue
-        with open(yaml_file) as f:
-            data = yaml.load(f.read())
-            if 'releases' not in data or not data['releases']:
-                # there might be yaml files without any releases
+    yaml_files = []
+    for d in (releases_indep_yaml_dir, releases_yaml_dir):
+        # only use yaml files. other files can't be parsed
+        with os.scandir(d) as it:
+            yaml_files += [e.path for e in it
+                           if e.name.endswith(('.yaml', '.yml')) and
+                           e.is_file()]
+
+    # the per project work is independent and mostly I/O bound so use
+    # a limited number of threads (to not run out of file descriptors)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(
+            lambda y: _process_project(y, args, upper_constraints,
+                                       open_reviews, obs_index),
+            yaml_files)
+        for result in results:
+            if result is None:
                 continue
-            v_release = find_highest_release_version(data['releases'])
-        # use tarball-base name if available
-        project_name_pkg = v_release['projects'][0].get('tarball-base',
-                                                        project_name)
-
-        # get version from upper-constraints.txt
-        if project_name in upper_constraints:
-            v_upper_constraints = upper_constraints[project_name]
-        else:
-            v_upper_constraints = '-'
-
-        # path to the corresponding .spec.j2 file
-        rpm_packaging_pkg_project_spec = os.path.join(
-            args['rpm-packaging-git-dir'],
-            'openstack', project_name_pkg,
-            '%s.spec.j2' % project_name_pkg)
-        v_rpm_packaging_pkg = find_rpm_packaging_pkg_version(
-            rpm_packaging_pkg_project_spec)
-
-        # version from build service published file
-        v_obs_published = find_openbuildservice_pkg_version(
-            args['obs_published_xml'], project_name)
-
-        # reviews for the given project
-        if project_name in open_reviews:
-            project_reviews = open_reviews[project_name]
-        else:
-            project_reviews = []
-
-        # add both versions to the project dict
-        projects[project_name] = V(version.parse(v_release['version']),
-                                   v_upper_constraints,
-                                   v_rpm_packaging_pkg,
-                                   project_reviews,
-                                   v_obs_published)
+            project_name, v = result
+            projects[project_name] = v
 
     include_obs = args['obs_published_xml']
     if args['format'] == 'text':
@@ -147,86 +214,94 @@ def process_args():
 def find_highest_release_version(releases):
     """get a list of dicts with a version key and find the highest version
     using PEP440 to compare the different versions"""
-    return max(releases, key=lambda x: version.parse(str(x['version'])))
+    return max(releases, key=lambda x: _parse(str(x['version'])))
 
 
 def _rpm_split_filename(filename):
-    """Taken from yum's rpmUtils.miscutils.py file
-    Pass in a standard style rpm fullname
+    """Based on yum's rpmUtils.miscutils.py file
+    Pass in a standard style rpm fullname (including the .rpm suffix)
     Return a name, version, release, epoch, arch, e.g.::
     foo-1.0-1.i386.rpm returns foo, 1.0, 1, i386
     1:bar-9-123a.ia64.rpm returns bar, 9, 123a, 1, ia64
+    Returns None if the filename is not a valid rpm fullname
     """
-    if filename[-4:] == '.rpm':
-        filename = filename[:-4]
-
-    archIndex = filename.rfind('.')
-    arch = filename[archIndex+1:]
-
-    relIndex = filename[:archIndex].rfind('-')
-    rel = filename[relIndex+1:archIndex]
-
-    verIndex = filename[:relIndex].rfind('-')
-    ver = filename[verIndex+1:relIndex]
-
-    epochIndex = filename.find(':')
-    if epochIndex == -1:
-        epoch = ''
-    else:
-        epoch = filename[:epochIndex]
-
-    name = filename[epochIndex + 1:verIndex]
-    return name, ver, rel, epoch, arch
+    m = _RPM_RE.match(filename)
+    if not m:
+        return None
+    return (m.group('name'), m.group('ver'), m.group('rel'),
+            m.group('epoch') or '', m.group('arch'))
 
 
-def find_openbuildservice_pkg_version(published_xml, pkg_name):
-    """find the version in the openbuildservice published xml for the given
-    pkg name"""
-    import pymod2pkg
-    import xml.etree.ElementTree as ET
-
+def _load_obs_index(published_xml):
+    """parse the openbuildservice published xml once and return a dict with
+    the binary rpm names as key and the version string as value"""
+    index = {}
     if published_xml and os.path.exists(published_xml):
-        with open(published_xml) as f:
-            tree = ET.fromstring(f.read())
-
-        distro_pkg_name = pymod2pkg.module2package(pkg_name, 'suse')
-        for child in tree:
-            if not child.attrib['name'].startswith('_') and \
-               child.attrib['name'].endswith('.rpm') and not \
-               child.attrib['name'].endswith('.src.rpm'):
-                (name, ver, release, epoch, arch) = _rpm_split_filename(
-                    child.attrib['name'])
-                if name == distro_pkg_name:
-                    return version.parse(ver)
-    return version.parse('0')
-
-
+        for event, elem in etree.iterparse(published_xml, events=('end',)):
+            parent = elem.getparent()
+            # only the direct children of the root element are entries
+            if parent is None or parent.getparent() is not None:
+                continue
+            filename = elem.get('name', '')
+            if not filename.startswith('_') and \
+               filename.endswith('.rpm') and not \
+               filename.endswith('.src.rpm'):
+                nvrea = _rpm_split_filename(filename)
+                # ignore entries which are not a valid rpm fullname
+                if nvrea is not None:
+                    (name, ver, release, epoch, arch) = nvrea
+                    # the first entry wins (same as the former linear
+                    # search). only parse the version on lookup. unrelated
+                    # packages might not have a PEP440 compatible version
+                    if name not in index:
+                        index[name] = ver
+            # free the already processed elements
+            elem.clear()
+    return index
+
+
+def find_openbuildservice_pkg_version(obs_index, pkg_name):
+    """find the version in the openbuildservice index (created with
+    _load_obs_index()) for the given pkg name"""
+    if not obs_index:
+        return ZERO_VERSION
+    distro_pkg_name = _module2package(pkg_name, 'suse')
+    if distro_pkg_name not in obs_index:
+        return ZERO_VERSION
+    return _parse(obs_index[distro_pkg_name])
+
+
+@functools.lru_cache(maxsize=None)
 def find_rpm_packaging_pkg_version(pkg_project_spec):
-    """get a spec.j2 template and get the version"""
+    """get a spec.j2 template and get the version. Cached because different
+    projects can use the same package (via tarball-base)"""
     if os.path.exists(pkg_project_spec):
         with open(pkg_project_spec) as f:
-            for line in f:
-                # if the template variable 'upstream_version' is set, use that
-                m = re.search(
-                    r"{%\s*set upstream_version\s*=\s*(?:upstream_version\()?"
-                    r"'(?P<version>.*)'(?:\))?\s*%}$", line)
+            # spec.j2 files are small so read them at once
+            lines = f.read().splitlines()
+        for line in lines:
+            # cheap string checks first so the regexes only run on
+            # the few lines which can match at all
+            # if the template variable 'upstream_version' is set, use that
+            if 'upstream_version' in line:
+                m = _UPSTREAM_RE.search(line)
                 if m:
-                    return version.parse(m.group('version'))
-                # check the Version field
-                m = re.search(r'^Version:\s*(?P<version>.*)\s*$', line)
+                    return _parse(m.group('version'))
+            # check the Version field
+            if line.startswith('Version:'):
+                m = _VERSION_RE.match(line)
                 if m:
                     if m.group('version') == '{{ py2rpmversion() }}':
                         return 'version unset'
-                    return version.parse(m.group('version'))
+                    return _parse(m.group('version'))
         # no version in spec found
-        print('ERROR: no version in %s found' % pkg_project_spec)
-        return version.parse('0')
-    return version.parse('0')
+        print('ERROR: no version in %s found' % pkg_project_spec,
+              file=sys.stderr)
+        return ZERO_VERSION
+    return ZERO_VERSION
 
 
-def _pretty_table(release, projects, include_obs):
-    from prettytable import PrettyTable
-    tb = PrettyTable()
+def _table_header(release, include_obs):
     fn = ['name',
           'release (%s)' % release,
           'u-c (%s)' % release,
@@ -235,30 +310,49 @@ def _pretty_table(release, projects, include_obs):
     if include_obs:
         fn += ['obs']
     fn += ['comment']
-    tb.field_names = fn
-
+    return fn
+
+
+def _classify(x):
+    """get the comment for the given V"""
+    if x.rpm_packaging_pkg == 'version unset':
+        return 'ok'
+    if x.rpm_packaging_pkg == ZERO_VERSION:
+        return 'unpackaged'
+    if x.rpm_packaging_pkg < x.release:
+        return 'needs upgrade'
+    if x.rpm_packaging_pkg == x.release:
+        if x.upper_constraints != '-' and \
+                x.release > _parse(x.upper_constraints):
+            return 'needs downgrade (u-c)'
+        return 'ok'
+    if x.rpm_packaging_pkg > x.release:
+        return 'needs downgrade'
+    return ''
+
+
+def _table_rows(projects, include_obs):
+    """get a list of rows (the comment is the last column) for the given
+    projects, sorted by comment and name"""
+    rows = []
     for p_name, x in projects.items():
-        if x.rpm_packaging_pkg == 'version unset':
-            comment = 'ok'
-        elif x.rpm_packaging_pkg == version.parse('0'):
-            comment = 'unpackaged'
-        elif x.rpm_packaging_pkg < x.release:
-            comment = 'needs upgrade'
-        elif x.rpm_packaging_pkg == x.release:
-            if x.upper_constraints != '-' and \
-                    x.release > version.parse(x.upper_constraints):
-                comment = 'needs downgrade (u-c)'
-            comment = 'ok'
-        elif x.rpm_packaging_pkg > x.release:
-            comment = 'needs downgrade'
-        else:
-            comment = ''
+        comment = _classify(x)
         row = [p_name, x.release, x.upper_constraints, x.rpm_packaging_pkg,
                x.reviews]
         if include_obs:
             row += [x.obs_published]
         row += [comment]
+        rows.append(row)
+    rows.sort(key=lambda r: (r[-1], r[0]))
+    return rows
+
+
+def _pretty_table(release, projects, include_obs):
+    from prettytable import PrettyTable
+    tb = PrettyTable()
+    tb.field_names = _table_header(release, include_obs)
 
+    for row in _table_rows(projects, include_obs):
         tb.add_row(row)
 
     return tb
@@ -266,31 +360,27 @@ def _pretty_table(release, projects, include_obs):
 
 def output_text(release, projects, include_obs):
     tb = _pretty_table(release, projects, include_obs)
-    print(tb.get_string(sortby='comment'))
+    print(tb.get_string())
 
 
 def output_html(release, projects, include_obs):
-    """adjust the comment color a big with an ugly hack"""
-    from lxml import html
-    tb = _pretty_table(release, projects, include_obs)
-    s = tb.get_html_string(sortby='comment')
-    tree = html.document_fromstring(s)
-    tab = tree.cssselect('table')
-    tab[0].attrib['style'] = 'border-collapse: collapse;'
-    trs = tree.cssselect('tr')
-    for t in trs:
-        t.attrib['style'] = 'border-bottom:1pt solid black;'
-    tds = tree.cssselect('td')
-    for t in tds:
-        if t.text_content() == 'unpackaged':
-            t.attrib['style'] = 'background-color:yellow'
-        elif t.text_content() == 'needs upgrade':
-            t.attrib['style'] = 'background-color:LightYellow'
-        elif t.text_content() == ('needs downgrade' or 'needs downgrade (uc)'):
-            t.attrib['style'] = 'background-color:red'
-        elif t.text_content() == 'ok':
-            t.attrib['style'] = 'background-color:green'
-    print(html.tostring(tree))
+    """render the table as html with a colored comment column"""
+    out = ['<html><body>', '<table style="border-collapse: collapse;">']
+    out.append('<tr>%s</tr>' % ''.join(
+        '<th>%s</th>' % html.escape(h)
+        for h in _table_header(release, include_obs)))
+    for row in _table_rows(projects, include_obs):
+        cells = ['<td>%s</td>' % html.escape(str(c)) for c in row[:-1]]
+        color = COMMENT_COLORS.get(row[-1])
+        if color:
+            cells.append('<td style="background-color:%s">%s</td>' % (
+                color, html.escape(row[-1])))
+        else:
+            cells.append('<td>%s</td>' % html.escape(row[-1]))
+        out.append('<tr style="border-bottom:1pt solid black;">%s</tr>' %
+                   ''.join(cells))
+    out += ['</table>', '</body></html>']
+    print('\n'.join(out))
 
 
 def read_upper_constraints(filename):
@@ -319,22 +409,21 @@ def _gerrit_open_reviews_per_file(release):
     else:
         branch = 'stable/%s' % release
 
+    # CURRENT_FILES includes the file list of the current revision in the
+    # result so there is no need for an extra request per review
     url_reviews = GERRIT_HOST + '/changes/?q=status:open+project:openstack/' \
-                                'rpm-packaging+branch:%s' % branch
-    res_reviews = requests.get(url_reviews)
+                                'rpm-packaging+branch:%s' \
+                                '&o=CURRENT_REVISION&o=CURRENT_FILES' % branch
+    res_reviews = _SESSION.get(url_reviews)
     if res_reviews.status_code == 200:
         data_reviews = json.loads(res_reviews.text.lstrip(gerrit_strip))
         for review in data_reviews:
-            url_files = GERRIT_HOST + '/changes/%s/revisions/current/files/' \
-                        % review['change_id']
-            res_files = requests.get(url_files)
-            if res_files.status_code == 200:
-                data_files = json.loads(res_files.text.lstrip(gerrit_strip))
-                for f in data_files.keys():
-                    # extract project name
-                    if f.startswith('openstack/') and f.endswith('spec.j2'):
-                        f = f.split('/')[1]
-                        data.setdefault(f, []).append(review['_number'])
+            revision = review['revisions'][review['current_revision']]
+            for f in revision.get('files', {}).keys():
+                # extract project name
+                if f.startswith('openstack/') and f.endswith('spec.j2'):
+                    f = f.split('/')[1]
+                    data.setdefault(f, []).append(review['_number'])
     return data
 
 